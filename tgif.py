@@ -1,11 +1,20 @@
 import telebot
 import requests
+from telebot import apihelper
+from requests.adapters import HTTPAdapter
 import os
 import random
 import zipfile
 import shutil
 import threading
 import subprocess
+import sqlite3
+import socket
+import uuid
+import json
+import tempfile
+from contextlib import closing
+from collections import OrderedDict
 from filelock import FileLock
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from PIL import Image
@@ -15,12 +24,18 @@ import logging
 from flask import Flask, send_from_directory, render_template_string, abort
 
 
+load_dotenv()
+# all: 单机运行bot+转换; bot: 只运行bot，转换交给worker节点; worker: 只运行转换
+ROLE = os.getenv('ROLE', 'all').lower()
+
 # creat .lock hub dir
-lock_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".lock")
+base_dir = os.path.dirname(os.path.abspath(__file__))
+lock_dir = os.path.join(base_dir, ".lock")
 if not os.path.exists(lock_dir):
     os.makedirs(lock_dir)
 
-hub_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "hub")
+# 多节点部署时hub需要放在共享存储上
+hub_dir = os.getenv('HUB_DIR', os.path.join(base_dir, "hub"))
 if not os.path.exists(hub_dir):
     os.makedirs(hub_dir)
 
@@ -68,11 +83,11 @@ def start_cleanup_thread():
     cleanup_thread.start()
     logger.info("Cleanup thread started")
 
-start_cleanup_thread()
+if ROLE != 'worker':
+    start_cleanup_thread()
 
 ### bot ###
 
-load_dotenv()
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 LOTTIE_CONVERTER = os.getenv('LOTTIE_CONVERTER')
 WEB_PORT = int(os.getenv('WEB_PORT', 8080))
@@ -80,7 +95,167 @@ WEB_DOMAIN = os.getenv('WEB_DOMAIN', 'localhost')
 WEB_DOMAIN_NGINX_HTTPS = os.getenv('WEB_DOMAIN_NGINX_HTTPS', '')
 THREAD_POOL_SIZE = int(os.getenv('THREAD_POOL_SIZE', 5))
 SEND_ZIP_IN_TG = os.getenv('SEND_ZIP_IN_TG', 'false').lower() in ['true', '1', 'yes']
-bot = telebot.TeleBot(BOT_TOKEN)
+# worker节点不连telegram，不需要BOT_TOKEN
+bot = telebot.TeleBot(BOT_TOKEN) if ROLE != 'worker' else None
+
+### telegram api ###
+
+# 所有telegram请求都走这里：复用连接，全局/每个聊天令牌桶限流，429时按retry_after退避
+TG_GLOBAL_RATE = float(os.getenv('TG_GLOBAL_RATE', 30))     # 每秒全局请求数
+TG_CHAT_RATE = float(os.getenv('TG_CHAT_RATE', 1))          # 私聊每秒消息数
+TG_GROUP_RATE = float(os.getenv('TG_GROUP_RATE', 20 / 60))  # 群聊每秒消息数
+TG_MAX_RETRY = int(os.getenv('TG_MAX_RETRY', 5))
+STICKERSET_CACHE_TTL = int(os.getenv('STICKERSET_CACHE_TTL', 120))
+FILE_URL_CACHE_TTL = 30 * 60 # telegram保证文件链接至少1小时有效
+PROGRESS_INTERVAL = float(os.getenv('PROGRESS_INTERVAL', 2)) # 进度消息最短编辑间隔
+TG_CACHE_SIZE = 4096 # 聊天令牌桶和各个缓存的最大条目数
+
+class TokenBucket:
+    """Thread-safe token bucket, acquire() blocks until a token is available"""
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        self.lock = threading.Lock()
+
+    def _take(self):
+        """Take a token if available, otherwise return the seconds to wait. Caller holds the lock"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if now >= self.blocked_until and self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return max(self.blocked_until - now, (1 - self.tokens) / self.rate)
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                wait = self._take()
+            if not wait:
+                return
+            time.sleep(wait)
+
+    def try_acquire(self):
+        """Take a token without blocking, return whether one was available"""
+        with self.lock:
+            return not self._take()
+
+    def pause(self, seconds):
+        """Hold every acquire() for the given seconds, used on retry_after"""
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+tg_session = requests.Session()
+tg_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=THREAD_POOL_SIZE * 2 + 4))
+global_bucket = TokenBucket(TG_GLOBAL_RATE, TG_GLOBAL_RATE)
+chat_buckets = OrderedDict()
+chat_buckets_lock = threading.Lock()
+# 已经用try_acquire拿到聊天令牌的请求，tg_request第一次发送时不再排队
+tg_local = threading.local()
+
+def get_chat_bucket(chat_id):
+    with chat_buckets_lock:
+        bucket = chat_buckets.get(chat_id)
+        if bucket is None:
+            if str(chat_id).startswith('-'): # 群组/频道
+                bucket = TokenBucket(TG_GROUP_RATE, 3)
+            else:
+                bucket = TokenBucket(TG_CHAT_RATE, 3)
+            chat_buckets[chat_id] = bucket
+            # 淘汰最久没有发消息的聊天
+            while len(chat_buckets) > TG_CACHE_SIZE:
+                chat_buckets.popitem(last=False)
+        else:
+            chat_buckets.move_to_end(chat_id)
+        return bucket
+
+def tg_request(method, url, params=None, files=None, **kwargs):
+    """Send a Bot API request through the shared session with flood control"""
+    chat_id = (params or {}).get("chat_id")
+    bucket = get_chat_bucket(chat_id) if chat_id is not None else None
+    prepaid, tg_local.prepaid = getattr(tg_local, "prepaid", False), False
+    for attempt in range(TG_MAX_RETRY):
+        if bucket and not (prepaid and attempt == 0):
+            bucket.acquire()
+        global_bucket.acquire()
+        if files:
+            # 重试时上传的文件需要从头读
+            for f in files.values():
+                f = f[1] if isinstance(f, tuple) else f
+                if hasattr(f, "seek"):
+                    f.seek(0)
+        resp = tg_session.request(method, url, params=params, files=files, **kwargs)
+        if resp.status_code != 429:
+            return resp
+        try:
+            retry_after = resp.json().get("parameters", {}).get("retry_after", 1)
+        except ValueError:
+            retry_after = 1
+        logger.warning(f"Telegram flood limit hit (chat {chat_id}), retry after {retry_after}s")
+        (bucket or global_bucket).pause(retry_after)
+    return resp
+
+# telebot的所有api调用都走tg_request
+if ROLE != 'worker':
+    apihelper.CUSTOM_REQUEST_SENDER = tg_request
+
+def edit_progress(text, chat_id, message_id, final=False):
+    """Edit a progress message, skipped when the chat has no token left unless final"""
+    if not final:
+        if not get_chat_bucket(chat_id).try_acquire():
+            return
+        tg_local.prepaid = True
+    try:
+        bot.edit_message_text(text, chat_id=chat_id, message_id=message_id)
+    except Exception as e:
+        logger.error(f"Error editing progress message: {e}")
+    finally:
+        tg_local.prepaid = False
+
+# 缓存按写入顺序排列，同一个缓存的ttl相同，所以最前面的最先过期
+stickerset_cache = OrderedDict()
+file_url_cache = OrderedDict()
+tg_cache_lock = threading.Lock()
+
+def cache_get(cache, key):
+    with tg_cache_lock:
+        item = cache.get(key)
+        if item is None or item[0] < time.time():
+            cache.pop(key, None)
+            return None
+        return item[1]
+
+def cache_put(cache, key, value, ttl):
+    now = time.time()
+    with tg_cache_lock:
+        cache.pop(key, None)
+        cache[key] = (now + ttl, value)
+        # 清理过期条目，并限制缓存大小
+        while cache and (next(iter(cache.values()))[0] < now or len(cache) > TG_CACHE_SIZE):
+            cache.popitem(last=False)
+
+def get_sticker_set(set_name, fresh=False):
+    """getStickerSet json response, cached for STICKERSET_CACHE_TTL seconds"""
+    if not fresh:
+        cached = cache_get(stickerset_cache, set_name)
+        if cached is not None:
+            logger.info(f"Using cached getStickerSet response for {set_name}")
+            return cached
+    resp = tg_request("post", f"https://api.telegram.org/bot{BOT_TOKEN}/getStickerSet", params={"name": set_name}, timeout=30)
+    info = resp.json()
+    if info.get("ok"):
+        cache_put(stickerset_cache, set_name, info, STICKERSET_CACHE_TTL)
+    return info
+
+def get_file_url(file_id):
+    url = cache_get(file_url_cache, file_id)
+    if url is None:
+        url = bot.get_file_url(file_id)
+        cache_put(file_url_cache, file_id, url, FILE_URL_CACHE_TTL)
+    return url
 
 # Initialize Flask app
 app = Flask(__name__)
@@ -235,7 +410,8 @@ def start_web_server():
     logger.info(f"Web server started on port {WEB_PORT}")
 
 # Start web server
-start_web_server()
+if ROLE != 'worker':
+    start_web_server()
 
 def get_filename_without_extension(filepath):
     return os.path.splitext(os.path.basename(filepath))[0]
@@ -262,7 +438,7 @@ def split_compress(sticker_gif, gif_list, sticker_zip, zip_name, part):
     return dstzip
 
 def execcmd(cmd, progress_callback=None):
-    
+    ok = False
     try:
         result = subprocess.run(cmd, shell=True, capture_output=True, text=True, timeout=600)
         # if result.stdout:
@@ -271,108 +447,345 @@ def execcmd(cmd, progress_callback=None):
             logger.warning(f"stderr: {result.stderr}")
         if result.returncode != 0:
             logger.error(f"command failed with return code {result.returncode}")
+        else:
+            ok = True
     except subprocess.TimeoutExpired:
         logger.error(f"command timed out: {cmd}")
     except Exception as e:
         logger.error(f"Error executing command: {e}")
     if progress_callback:
         progress_callback()
+    return ok
 
-def stickerset2gif(sticker_ori, sticker_gif, srcstickerset, chatid): # hub = hub/xxx
-    sz = len(srcstickerset)
-    process_count = 0
-    progress_lock = threading.Lock()
-    progress_msg = bot.send_message(chatid, f"转换进度 {process_count}/{sz}")
-    def update_progress():
-        nonlocal process_count
-        with progress_lock:
-            process_count += 1  
-            bot.edit_message_text(
-                f"转换进度 {process_count}/{sz}", 
-                chat_id=chatid, 
-                message_id=progress_msg.message_id
-            )
-    # sticker_ori 可能包含不同的文件类型
-    if LOTTIE_CONVERTER: # 手动编译的lottie-to-gif
-        with ThreadPoolExecutor(max_workers=THREAD_POOL_SIZE) as executor:
-            futures = []
-
-            for srcsticker in srcstickerset:
-                srcsticker_ne = get_filename_without_extension(srcsticker) # miku.tgs
-                srcsticker_ext = srcsticker.split('.')[-1] # tgs
-                src = os.path.join(sticker_ori, srcsticker) # hub/xxx/miku.tgs
-                dst = os.path.join(sticker_gif, srcsticker_ne+".gif") # hub/xxxgif/miku.gif
-                if srcsticker_ext in ['webm', 'mp4']:
-                    # 处理视频的gif
-                    cmd = f"ffmpeg -i {src} {dst}"
-                    logger.info(f"Executing command: {cmd}")
-                elif srcsticker_ext == 'tgs': 
-                    # 处理tgs的gif
-                    cmd = f"{LOTTIE_CONVERTER} {src} --output {dst}"
-                    logger.info(f"Executing command: {cmd}")
-                else :
-                    # 处理透明图片的gif
-                    cmd = f"ffmpeg -i {src} -vf \"split[s0][s1];[s0]palettegen=reserve_transparent=1[p];[s1][p]paletteuse=alpha_threshold=128\" -loop 0 {dst}"
-                    logger.info(f"Executing command: {cmd}")
-                futures.append(executor.submit(execcmd, cmd, update_progress))
-            # 获取结果
-            for future in futures:
-                future.result()
-    else :  
-        # user docker
-        # in sticker_ori/ : xxx.tgs -> xxx.tgs.gif
-        execcmd(f"docker run --rm -v {sticker_ori}:/source edasriyan/lottie-to-gif")
-
-        # update progress
-        process_count += len([f for f in os.listdir(sticker_ori) if f.endswith('.tgs')])
-
-        if process_count != 0 : # 没有tgs文件在docker中转化，不能修改相同内容
-            bot.edit_message_text(
-                f"转换进度 {process_count}/{sz}", 
-                chat_id=chatid, 
-                message_id=progress_msg.message_id
+def convert_cmd(src, dst, ext):
+    if ext in ['webm', 'mp4']:
+        # 处理视频的gif
+        return f"ffmpeg -i {src} {dst}"
+    if ext == 'tgs':
+        # 处理tgs的gif
+        return f"{LOTTIE_CONVERTER} {src} --output {dst}"
+    # 处理透明图片的gif
+    return f"ffmpeg -i {src} -vf \"split[s0][s1];[s0]palettegen=reserve_transparent=1[p];[s1][p]paletteuse=alpha_threshold=128\" -loop 0 {dst}"
+
+def docker_tgs2gif(srcs, dsts):
+    # 没有手动编译的lottie-to-gif时用docker，镜像会转换挂载目录下的所有tgs
+    # 所以把一组文件放进同一个临时目录，只启动一次容器: xxx.tgs -> xxx.tgs.gif
+    tmp = tempfile.mkdtemp(prefix="tgif-")
+    try:
+        for src in srcs:
+            shutil.copy(src, tmp)
+        execcmd(f"docker run --rm -v {tmp}:/source edasriyan/lottie-to-gif")
+        for src, dst in zip(srcs, dsts):
+            out = os.path.join(tmp, os.path.basename(src) + ".gif")
+            if os.path.exists(out):
+                shutil.move(out, dst)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+### job queue ###
+
+# 转换任务放在sqlite队列中，bot节点投递，worker节点(可以是多台机器)租用并执行
+# 任务中的路径都是相对hub_dir的，worker各自拼接自己挂载的共享hub
+JOB_DB = os.getenv('JOB_DB', os.path.join(base_dir, "jobs.db"))
+JOB_LEASE = int(os.getenv('JOB_LEASE', 60)) # 租约秒数，worker心跳会自动续租
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', 3)) # 租约过期(worker失联)后最多重新派发的次数
+JOB_WAIT_TIMEOUT = int(os.getenv('JOB_WAIT_TIMEOUT', 3600))
+JOB_POLL = float(os.getenv('JOB_POLL', 1))
+TGS_CHUNK_SIZE = int(os.getenv('TGS_CHUNK_SIZE', 20)) # 每个tgs任务包含的文件数，docker每个任务只启动一次
+WORKER_ID = os.getenv('WORKER_ID', f"{socket.gethostname()}-{os.getpid()}")
+
+def job_db():
+    conn = sqlite3.connect(JOB_DB, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def init_job_db():
+    with closing(job_db()) as conn:
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                batch TEXT NOT NULL,
+                src TEXT NOT NULL, -- json列表，一个任务可以包含多个文件
+                dst TEXT NOT NULL,
+                ext TEXT NOT NULL,
+                size INTEGER NOT NULL DEFAULT 1,
+                status TEXT NOT NULL DEFAULT 'pending',
+                worker TEXT,
+                lease_until REAL,
+                attempts INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS jobs_status ON jobs(status, lease_until);
+            CREATE INDEX IF NOT EXISTS jobs_batch ON jobs(batch);
+            CREATE TABLE IF NOT EXISTS workers (
+                id TEXT PRIMARY KEY,
+                last_seen REAL NOT NULL,
+                kinds TEXT NOT NULL DEFAULT '',
+                running INTEGER NOT NULL DEFAULT 0,
+                done INTEGER NOT NULL DEFAULT 0
+            );
+        """)
+
+def submit_jobs(jobs):
+    """Enqueue (srcs, dsts, ext) conversion jobs, return the batch id"""
+    batch = uuid.uuid4().hex
+    with closing(job_db()) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.executemany(
+            "INSERT INTO jobs (batch, src, dst, ext, size) VALUES (?, ?, ?, ?, ?)",
+            [(batch, json.dumps(srcs), json.dumps(dsts), ext, len(srcs)) for srcs, dsts, ext in jobs]
+        )
+        conn.execute("COMMIT")
+    logger.info(f"Submitted {len(jobs)} jobs in batch {batch}")
+    return batch
+
+def job_kind(ext):
+    # tgs需要lottie-to-gif或docker，其余格式都用ffmpeg
+    return 'tgs' if ext == 'tgs' else 'ffmpeg'
+
+def worker_capabilities():
+    """Job kinds this node is able to convert"""
+    kinds = set()
+    if LOTTIE_CONVERTER or shutil.which("docker") is not None:
+        kinds.add('tgs')
+    if shutil.which("ffmpeg") is not None:
+        kinds.add('ffmpeg')
+    return kinds
+
+def kinds_filter(kinds):
+    """SQL filter on jobs.ext for the given job kinds"""
+    if kinds == {'tgs', 'ffmpeg'}:
+        return ""
+    if kinds == {'tgs'}:
+        return " AND ext = 'tgs'"
+    return " AND ext != 'tgs'"
+
+def lease_job(conn, worker_id, ext_filter=""):
+    """Lease one pending job, or a running job whose worker stopped heartbeating"""
+    now = time.time()
+    leasable = f"(status = 'pending' OR (status = 'running' AND lease_until < ?)){ext_filter}"
+    # 先只读检查，空闲时不去抢写锁
+    if conn.execute(f"SELECT 1 FROM jobs WHERE {leasable} LIMIT 1", (now,)).fetchone() is None:
+        return None
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        # 租约过期且重新派发次数用完的任务直接判失败
+        conn.execute(
+            "UPDATE jobs SET status = 'failed' WHERE status = 'running' AND lease_until < ? AND attempts >= ?",
+            (now, JOB_MAX_ATTEMPTS)
+        )
+        job = conn.execute(
+            f"SELECT * FROM jobs WHERE {leasable} ORDER BY id LIMIT 1",
+            (now,)
+        ).fetchone()
+        if job is not None:
+            if job["status"] == 'running':
+                logger.warning(f"Re-leasing job {job['id']} held by dead worker {job['worker']}")
+            conn.execute(
+                "UPDATE jobs SET status = 'running', worker = ?, lease_until = ?, attempts = attempts + 1 WHERE id = ?",
+                (worker_id, now + JOB_LEASE, job["id"])
             )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return job
 
-        # in sticker_ori/ move xxx.tgs.gif to sticker_gif/
-        execcmd(f"mv {sticker_ori}/*.gif {sticker_gif}")
-        # in sticker_gif/ : xxx.tgs.gif -> xxx.gif
-        for file in os.listdir(sticker_gif):
-            if file.endswith('.tgs.gif'):
-                nfile = file.replace('.tgs.gif', '.gif')
-                os.rename(os.path.join(sticker_gif, file), os.path.join(sticker_gif, nfile))
-
-        with ThreadPoolExecutor(max_workers=THREAD_POOL_SIZE) as executor:
-            futures = []
-
-            for srcsticker in srcstickerset:
-                srcsticker_ne = get_filename_without_extension(srcsticker) # miku.tgs
-                srcsticker_ext = srcsticker.split('.')[-1] # tgs
-                if srcsticker_ext == 'tgs': continue
-                src = os.path.join(sticker_ori, srcsticker) # hub/xxx/miku.tgs
-                dst = os.path.join(sticker_gif, srcsticker_ne+".gif") # hub/xxxgif/miku.gif
-                if srcsticker_ext in ['webm', 'mp4']:
-                    # video
-                    cmd = f"ffmpeg -i {src} {dst}"
-                    logger.info(f"Executing command: {cmd}")
-                else :
-                    # picture
-                    cmd = f"ffmpeg -i {src} -vf \"split[s0][s1];[s0]palettegen=reserve_transparent=1[p];[s1][p]paletteuse=alpha_threshold=128\" -loop 0 {dst}"
-                    logger.info(f"Executing command: {cmd}")
-                futures.append(executor.submit(execcmd, cmd, update_progress))
-                    
-            # 获取结果
-            for future in futures:
-                future.result()
+def finish_job(conn, job_id, worker_id, ok):
+    # 只有仍持有租约的worker才能提交结果；转换失败不重试，同样的输入再跑也是失败
+    conn.execute(
+        "UPDATE jobs SET status = ?, lease_until = NULL WHERE id = ? AND worker = ? AND status = 'running'",
+        ('done' if ok else 'failed', job_id, worker_id)
+    )
+
+def heartbeat(worker_id, kinds, running, done):
+    now = time.time()
+    with closing(job_db()) as conn:
+        conn.execute(
+            "INSERT INTO workers (id, last_seen, kinds, running, done) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(id) DO UPDATE SET last_seen = excluded.last_seen, kinds = excluded.kinds, "
+            "running = excluded.running, done = excluded.done",
+            (worker_id, now, ",".join(sorted(kinds)), running, done)
+        )
+        # WORKER_ID默认带pid，重启后是新的一行，清理早已失联的worker
+        conn.execute("DELETE FROM workers WHERE last_seen < ?", (now - 10 * JOB_LEASE,))
+        # 续租自己手上的任务
+        conn.execute(
+            "UPDATE jobs SET lease_until = ? WHERE worker = ? AND status = 'running'",
+            (now + JOB_LEASE, worker_id)
+        )
+
+def alive_workers():
+    """Map of live worker id to the job kinds it can convert"""
+    with closing(job_db()) as conn:
+        return {row["id"]: set(row["kinds"].split(",")) - {""} for row in conn.execute(
+            "SELECT id, kinds FROM workers WHERE last_seen > ?", (time.time() - JOB_LEASE,)
+        )}
+
+def batch_progress(batch):
+    with closing(job_db()) as conn:
+        return {row["status"]: row["n"] for row in conn.execute(
+            "SELECT status, SUM(size) AS n FROM jobs WHERE batch = ? GROUP BY status", (batch,)
+        )}
+
+def drop_batch(batch):
+    with closing(job_db()) as conn:
+        conn.execute("DELETE FROM jobs WHERE batch = ?", (batch,))
+
+def wait_jobs(batch, total, progress_callback=None):
+    """Block until every job in the batch is done or failed, return the failed file count"""
+    deadline = time.time() + JOB_WAIT_TIMEOUT
+    last = 0
+    while True:
+        counts = batch_progress(batch)
+        finished = counts.get('done', 0) + counts.get('failed', 0)
+        if finished != last and progress_callback:
+            last = finished
+            try:
+                progress_callback(finished)
+            except Exception as e:
+                logger.error(f"Error updating progress of batch {batch}: {e}")
+        if finished >= total:
+            break
+        if time.time() > deadline:
+            logger.warning(f"Batch {batch} timed out with {total - finished} unfinished jobs")
+            break
+        time.sleep(JOB_POLL)
+    drop_batch(batch)
+    return total - counts.get('done', 0)
+
+def convert_job(job):
+    srcs, dsts = [], []
+    for src, dst in zip(json.loads(job["src"]), json.loads(job["dst"])):
+        src, dst = os.path.join(hub_dir, src), os.path.join(hub_dir, dst)
+        if not os.path.exists(src):
+            logger.error(f"Source file not found for job {job['id']}: {src}")
+            continue
+        # 上一次失败的残留文件会让ffmpeg卡在覆盖确认
+        if os.path.exists(dst):
+            os.remove(dst)
+        srcs.append(src)
+        dsts.append(dst)
+    if job["ext"] == 'tgs' and not LOTTIE_CONVERTER:
+        logger.info(f"Converting {len(srcs)} tgs files with docker")
+        docker_tgs2gif(srcs, dsts)
+    else:
+        for src, dst in zip(srcs, dsts):
+            cmd = convert_cmd(src, dst, job["ext"])
+            logger.info(f"Executing command: {cmd}")
+            execcmd(cmd)
+    return job["size"] == len(dsts) and all(os.path.exists(dst) for dst in dsts)
+
+worker_stats = {"running": 0, "done": 0}
+worker_stats_lock = threading.Lock()
+
+def worker_loop(worker_id, ext_filter):
+    conn = job_db()
+    while True:
+        try:
+            job = lease_job(conn, worker_id, ext_filter)
+        except Exception as e:
+            logger.error(f"Error leasing job: {e}")
+            job = None
+        if job is None:
+            time.sleep(JOB_POLL)
+            continue
+        with worker_stats_lock:
+            worker_stats["running"] += 1
+        ok = False
+        try:
+            ok = convert_job(job)
+        except Exception as e:
+            logger.error(f"Error converting job {job['id']}: {e}")
+        try:
+            finish_job(conn, job["id"], worker_id, ok)
+        except Exception as e:
+            logger.error(f"Error finishing job {job['id']}: {e}")
+        with worker_stats_lock:
+            worker_stats["running"] -= 1
+            worker_stats["done"] += 1
+
+def heartbeat_loop(worker_id, kinds):
+    while True:
+        try:
+            with worker_stats_lock:
+                running, done = worker_stats["running"], worker_stats["done"]
+            heartbeat(worker_id, kinds, running, done)
+        except Exception as e:
+            logger.error(f"Error sending heartbeat: {e}")
+        time.sleep(max(JOB_LEASE // 4, 1))
+
+def start_workers(size):
+    kinds = worker_capabilities()
+    if not kinds:
+        logger.error("Neither ffmpeg nor a tgs converter is available, worker not started")
+        return []
+    # 先发一次心跳，bot节点马上就能看到这个worker
+    heartbeat(WORKER_ID, kinds, 0, 0)
+    ext_filter = kinds_filter(kinds)
+    threads = [threading.Thread(target=heartbeat_loop, args=(WORKER_ID, kinds), daemon=True)]
+    threads += [threading.Thread(target=worker_loop, args=(WORKER_ID, ext_filter), daemon=True) for _ in range(size)]
+    for t in threads:
+        t.start()
+    logger.info(f"Worker {WORKER_ID} started with {size} threads for {sorted(kinds)}")
+    return threads
+
+init_job_db()
+
+def stickerset2gif(sticker_ori, sticker_gif, srcstickerset, chatid): # hub = hub/xxx
+    # sticker_ori 可能包含不同的文件类型，全部投递到任务队列，由worker转换
+    # 视频和图片每个文件一个任务，tgs每TGS_CHUNK_SIZE个文件一个任务
+    jobs, tgs_srcs, tgs_dsts = [], [], []
+    for srcsticker in srcstickerset:
+        srcsticker_ne = get_filename_without_extension(srcsticker) # miku.tgs
+        srcsticker_ext = srcsticker.split('.')[-1] # tgs
+        src = os.path.relpath(os.path.join(sticker_ori, srcsticker), hub_dir) # xxx/sticker_ori/miku.tgs
+        dst = os.path.relpath(os.path.join(sticker_gif, srcsticker_ne+".gif"), hub_dir) # xxx/sticker_gif/miku.gif
+        if srcsticker_ext == 'tgs':
+            tgs_srcs.append(src)
+            tgs_dsts.append(dst)
+        else:
+            jobs.append(([src], [dst], srcsticker_ext))
+    for i in range(0, len(tgs_srcs), TGS_CHUNK_SIZE):
+        jobs.append((tgs_srcs[i:i+TGS_CHUNK_SIZE], tgs_dsts[i:i+TGS_CHUNK_SIZE], 'tgs'))
+
+    # 没有在线worker能处理的任务不投递，否则会一直等到超时
+    capable = set().union(*alive_workers().values())
+    unsupported = sorted({job_kind(ext) for _, _, ext in jobs} - capable)
+    if unsupported:
+        names = {'tgs': "动态(tgs)", 'ffmpeg': "视频/图片"}
+        bot.send_message(chatid, f"当前没有在线的转换节点能处理{'、'.join(names[k] for k in unsupported)}表情")
+        jobs = [job for job in jobs if job_kind(job[2]) in capable]
+
+    if jobs:
+        sz = sum(len(srcs) for srcs, _, _ in jobs)
+        progress_msg = bot.send_message(chatid, f"转换进度 0/{sz}")
+        last_edit = 0
+        def update_progress(finished):
+            nonlocal last_edit
+            # 进度消息限频，最后一次必须更新
+            if finished < sz and time.time() - last_edit < PROGRESS_INTERVAL:
+                return
+            last_edit = time.time()
+            edit_progress(f"转换进度 {finished}/{sz}", chatid, progress_msg.message_id, final=finished >= sz)
+        batch = submit_jobs(jobs)
+        failed = wait_jobs(batch, sz, update_progress)
+        if failed:
+            logger.warning(f"{failed} files failed to convert in batch {batch}")
+
+    bad_gif = [f for f in srcstickerset if not os.path.exists(os.path.join(sticker_gif, get_filename_without_extension(f) + ".gif"))]
+    if bad_gif:
+        bot.send_message(chatid, f"以下{len(bad_gif)}个表情转换失败：\n{', '.join(bad_gif)}")
+        logger.warning(f"Failed to convert stickers: {bad_gif}")
 
 def download_sticker(bot, sticker_info, hub, progress_callback=None):
     """Download a single sticker file"""
     try:
-        url = bot.get_file_url(sticker_info["file_id"])
+        url = get_file_url(sticker_info["file_id"])
         file_name_ne = sticker_info["file_unique_id"]
         ext = url.split('.')[-1]
         file_name = file_name_ne + "." + ext
         
-        r = requests.get(url)
+        r = tg_session.get(url, timeout=60)
         r.raise_for_status()
         
         file_path = os.path.join(hub, file_name)
@@ -392,7 +805,7 @@ def download_sticker(bot, sticker_info, hub, progress_callback=None):
         logger.error(f"Error downloading sticker {sticker_info.get('file_unique_id', 'unknown')}: {e}")
         return False, file_name, file_name_ne + ".gif"
 
-def get_stickerset_info(message):
+def get_stickerset_info(message, fresh=False):
     set_name = ""
     if message.sticker:
         set_name = message.sticker.set_name
@@ -400,12 +813,11 @@ def get_stickerset_info(message):
         set_name = message.text.split('/')[-1]
     else :
         set_name = message.text
-    resp = requests.post(f"https://api.telegram.org/bot{BOT_TOKEN}/getStickerSet", data={"name":set_name})
-    return resp.json()
+    return get_sticker_set(set_name, fresh)
 
 def opt_stickerset(message, nocache):
     logger.info(f"Processing stickerset message: {message}")
-    sticker_info = get_stickerset_info(message)
+    sticker_info = get_stickerset_info(message, nocache)
     logger.debug(f"Sticker set response: {sticker_info}")
     if not sticker_info["ok"]:
         bot.reply_to(message, "焯！发的什么垃圾，不能识别捏")
@@ -454,15 +866,18 @@ def opt_stickerset(message, nocache):
             downloaded_count = 0
             progress_lock = threading.Lock()
             progress_msg = bot.send_message(message.chat.id, f"下载进度 {downloaded_count}/{sz}")
+            last_edit = 0
             def update_progress():
-                nonlocal downloaded_count
+                nonlocal downloaded_count, last_edit
                 with progress_lock:
                     downloaded_count += 1
-                    bot.edit_message_text(
-                        f"下载进度 {downloaded_count}/{sz}", 
-                        chat_id=message.chat.id, 
-                        message_id=progress_msg.message_id
-                    )
+                    count = downloaded_count
+                    # 进度消息限频，最后一次必须更新
+                    if count < sz and time.time() - last_edit < PROGRESS_INTERVAL:
+                        return
+                    last_edit = time.time()
+                # 在锁外编辑，避免限流时阻塞其他下载线程
+                edit_progress(f"下载进度 {count}/{sz}", message.chat.id, progress_msg.message_id, final=count == sz)
             # Use ThreadPoolExecutor for concurrent downloads
             with ThreadPoolExecutor(max_workers=THREAD_POOL_SIZE) as executor:
                 future_to_sticker = {
@@ -549,7 +964,6 @@ def opt_stickerset(message, nocache):
                 shutil.rmtree(sticker_dir)
 
 
-@bot.message_handler(commands=['stickerset2gif'])
 def stickerset(message):
     logger.info(f"Stickerset command received: {message}")
     nocache = True if "nocache" in message.text else False
@@ -612,105 +1026,268 @@ def round1(message):
     sent_msg = bot.reply_to(message, "我已经想好了数字，请开始猜吧")
     bot.register_next_step_handler(sent_msg, roundx, x, n[0], n[1])
 
-@bot.message_handler(commands=['num'])
 def num(message):
     sent_msg = bot.reply_to(message, "猜数字游戏，请发送两个整数（用空格分开）代表所猜整数的范围。\n例如`5 10`", parse_mode="Markdown")
     bot.register_next_step_handler(sent_msg, round1)
 
-from functools import reduce
+from functools import reduce, lru_cache
+
+NIM_MAX_PILES = 10
+NIM_MAX_SIZE = 10 ** 9
+NIM_MAX_SUBTRACT = 64 # 减法集合中最大的数
+NIM_TABLE_SIZE = 4096 # SG值预计算表长度，超过的部分用周期推出
 
 def to_bin(value, num):#十进制数据，二进制位宽
-    bin_chars = ""
-    temp = value
-    for i in range(num):
-        bin_char = bin(temp % 2)[-1]
-        temp = temp // 2
-        bin_chars = bin_char + bin_chars
-    return bin_chars.upper()#输出指定位宽的二进制字符串
-
-def gen():
-    a = [random.randint(1,16) for i in range(3)]
-    xor = reduce(lambda x, y : x^y , a)
-    while not xor:
-        a = [random.randint(1,16) for i in range(3)]
-        xor = reduce(lambda x, y : x^y , a)
-    return a
-
-def gentip(a, simple=True):
-    b = [to_bin(i, 5) for i in a]
+    return format(value, f"0{num}b")#输出指定位宽的二进制字符串
+
+def mex(values):
+    m = 0
+    while m in values:
+        m += 1
+    return m
+
+@lru_cache(maxsize=64)
+def subtraction_table(subtract):
+    """SG table of a subtraction game, plus (start, period) of its periodic tail or None"""
+    table = []
+    for n in range(NIM_TABLE_SIZE):
+        table.append(mex({table[n - s] for s in subtract if s <= n}))
+    # 有限减法集合的SG序列最终是周期的：
+    # 若 g(n)=g(n+p) 对连续 max(subtract) 个 n 成立，则之后一直成立
+    width = max(subtract)
+    for period in range(1, NIM_TABLE_SIZE // 2):
+        start = NIM_TABLE_SIZE - period
+        while start > 0 and table[start - 1] == table[start - 1 + period]:
+            start -= 1
+        if NIM_TABLE_SIZE - period - start >= width:
+            return table, start, period
+    # 表内找不到周期，只能回答表长以内的石堆
+    logger.warning(f"No period found for subtraction set {subtract}")
+    return table, None, None
+
+class NimGame:
+    """Take-away game on several piles, optionally with a subtraction set or misère rule"""
+    def __init__(self, piles=3, size=16, subtract=None, misere=False):
+        self.piles = piles
+        self.size = size
+        self.subtract = tuple(sorted(set(subtract))) if subtract else None
+        self.misere = misere
+
+    def grundy(self, n):
+        if self.subtract is None:
+            return n
+        table, start, period = subtraction_table(self.subtract)
+        if n < len(table):
+            return table[n]
+        if period is None:
+            raise ValueError(f"减法集合{list(self.subtract)}只支持每堆少于{len(table)}个")
+        return table[start + (n - start) % period]
+
+    def takes(self, n):
+        """Legal amounts to take from a pile of n"""
+        if self.subtract is None:
+            return range(1, n + 1)
+        return [s for s in self.subtract if s <= n]
+
+    def can_move(self, a):
+        return any(self.takes(x) for x in a)
+
+    def xor(self, a):
+        return reduce(lambda x, y : x^y , (self.grundy(x) for x in a), 0)
+
+    def is_winning(self, a):
+        """Whether the player to move can force a win"""
+        if self.misere:
+            if all(x <= 1 for x in a):
+                return sum(a) % 2 == 0
+        return self.xor(a) != 0
+
+    def best_move(self, a):
+        """Return (pile index, amount) of a winning move, or None if a is losing"""
+        if not self.can_move(a) or not self.is_winning(a):
+            return None
+        if self.misere:
+            big = [i for i, x in enumerate(a) if x > 1]
+            if not big:
+                return a.index(1), 1
+            if len(big) == 1:
+                # 只剩一堆大于1时，留下奇数个1给对手
+                i = big[0]
+                ones = sum(1 for x in a if x == 1)
+                return i, a[i] - (1 if ones % 2 == 0 else 0)
+        xor = self.xor(a)
+        for i, x in enumerate(a):
+            target = self.grundy(x) ^ xor
+            if self.subtract is None:
+                if target < x:
+                    return i, x - target
+                continue
+            for s in self.takes(x):
+                if self.grundy(x - s) == target:
+                    return i, s
+        return None
+
+    def random_move(self, a):
+        i = random.choice([i for i, x in enumerate(a) if self.takes(x)])
+        if self.subtract is None:
+            return i, random.randint(1, a[i])
+        return i, random.choice(self.takes(a[i]))
+
+    def gen(self):
+        """Random start position that is winning for the first player"""
+        for _ in range(100):
+            a = [random.randint(1, self.size) for i in range(self.piles)]
+            if self.is_winning(a):
+                return a
+        return a
+
+    def rules(self):
+        if self.subtract is None:
+            take = "再<b>至少</b>取走一个石头，<b>至多</b>全部取完"
+        else:
+            take = "再取走石头，取走的数量必须是{}中的一个".format(list(self.subtract))
+        if self.misere:
+            win = "谁取走最后一个石头，谁就输了"
+        elif self.subtract is None:
+            win = "那一个先取完所有石头，谁就赢了"
+        else:
+            win = "轮到谁无法操作，谁就输了"
+        return take, win
+
+def parse_nim(s):
+    """/nim [堆数 [每堆最大个数]] [sub=1,3,4] [misere]"""
+    numbers, subtract, misere = [], None, False
+    for arg in s.split()[1:]:
+        if arg.isdigit():
+            numbers.append(int(arg))
+        elif arg.startswith("sub="):
+            subtract = [int(x) for x in arg[4:].split(",") if x.isdigit()]
+            if not subtract or min(subtract) < 1 or max(subtract) > NIM_MAX_SUBTRACT:
+                raise ValueError(f"减法集合中的数需要在1到{NIM_MAX_SUBTRACT}之间")
+        elif arg in ["misere", "反常"]:
+            misere = True
+        else:
+            raise ValueError(f"无法识别的参数{arg}")
+    if len(numbers) > 2:
+        raise ValueError("最多两个整数：堆数和每堆最大个数")
+    piles = numbers[0] if len(numbers) > 0 else 3
+    size = numbers[1] if len(numbers) > 1 else 16
+    if not 1 <= piles <= NIM_MAX_PILES:
+        raise ValueError(f"堆数需要在1到{NIM_MAX_PILES}之间")
+    if not 1 <= size <= NIM_MAX_SIZE:
+        raise ValueError(f"每堆个数需要在1到{NIM_MAX_SIZE}之间")
+    if misere and subtract:
+        raise ValueError("反常规则暂不支持减法集合")
+    if subtract:
+        if size < min(subtract):
+            raise ValueError(f"每堆最大个数不能小于减法集合中最小的数{min(subtract)}")
+        if size >= NIM_TABLE_SIZE and subtraction_table(tuple(sorted(set(subtract))))[2] is None:
+            raise ValueError(f"该减法集合只支持每堆少于{NIM_TABLE_SIZE}个")
+    return NimGame(piles, size, subtract, misere)
+
+def gentip(game, a, simple=True):
+    values = [game.grundy(i) for i in a]
+    xor = game.xor(a)
+    width = max([v.bit_length() for v in values] + [xor.bit_length(), 1])
+    b = [to_bin(i, width) for i in values]
     s = ''
     for i in b:
         s += '⊕'+i
-    xor = to_bin(reduce(lambda x, y : x^y , a), 5)
-    rt = s[1:]+"="+xor 
+    rt = s[1:]+"="+to_bin(xor, width)
     if simple: return rt
+    if game.subtract is not None:
+        rt += ",每堆石头的SG值为mex{取走后剩余石堆的SG值},当SG值异或为0则是必胜态,你的目标是让这些SG值异或为0。"
+        rt += "SG值依次是{}".format(values)
+        return rt
     rt += ",当异或为0则是必胜态,你的目标是让这些数异或为0。"
+    xor = to_bin(xor, width)
     rt += "注意到 {}⊕{}=0 如果一堆石头个数是x, x>x⊕{}说明可以让x减少<b>到</b>x⊕{},从而使得异或和为0".format(s[1:], xor, xor, xor)
+    if game.misere:
+        rt += "。反常规则下唯一的例外：当操作后所有堆都不超过1个时，要给对手留下奇数堆1个石头"
     return rt
 
-def robot_opt(a):
-    xor = reduce(lambda x, y : x^y , a)
-    if not xor:
-        for i in range(len(a)):
-            if a[i]:
-                d = random.randint(1, a[i])
-                a[i] -= d
-                return "第{}个数减少{}".format(i+1,d)
-
-    for i,j in enumerate(a):
-        if j > (j^xor):
-            logger.debug(f"{i}th {j} sub {j-(j^xor)} become {j^xor}")
-            sub = j-(j^xor)
-            a[i] = j^xor
-            return "第{}个数减少{}".format(i+1,sub)
-
-def nim_round(message, a):
+def robot_opt(game, a):
+    move = game.best_move(a)
+    if move is None:
+        move = game.random_move(a)
+    else:
+        logger.debug(f"{move[0]}th {a[move[0]]} sub {move[1]}")
+    i, sub = move
+    a[i] -= sub
+    return "第{}个数减少{}".format(i+1,sub)
+
+def nim_over(message, win):
+    if win:
+        bot.reply_to(message, "只能说有点东西，但不多！")
+        bot.send_sticker(chat_id=message.chat.id, sticker="CAACAgQAAxkBAAICSmYZDKNa_Hp_W090-PE4EJmOAAHjqQACDAMAAtkjZCEhtSw_8gOOaTQE", reply_to_message_id=message.id)
+    else:
+        bot.reply_to(message, "菜就多练，输不起就别玩！")
+        bot.send_sticker(chat_id=message.chat.id, sticker="CAACAgQAAxkBAAICUGYZDa7nbIrY0R1g6AM7is5xeiejAAIPAwAC2SNkIeveH7n5wxyoNAQ", reply_to_message_id=message.id)
+
+def nim_round(message, game, a):
     n = read_two_integers(message.text)
     if n is None: 
         bot.reply_to(message, "发送两个整数，用空格分开。您犯规了捏！请重新开始吧")
         return 
     n0 = n[0]-1
-    if n0 not in range(len(a)) or n[1] not in range(1, a[n0]+1): 
+    if n0 not in range(len(a)) or n[1] not in game.takes(a[n0]): 
         bot.reply_to(message, "两个整数范围非法。您犯规了捏！请重新开始吧")
         bot.send_sticker(chat_id=message.chat.id, sticker="CAACAgQAAxkBAAICaGYZDyb3_KrxmtP2gy2zpEqRUrbNAAIHAwAC2SNkIUzkymsUveDgNAQ", reply_to_message_id=message.id)
         return 
     a[n0] -= n[1]
     bot.reply_to(message, "现在的石堆状态是{}".format(a))
-    if not sum(a):
-        bot.reply_to(message, "只能说有点东西，但不多！")
-        bot.send_sticker(chat_id=message.chat.id, sticker="CAACAgQAAxkBAAICSmYZDKNa_Hp_W090-PE4EJmOAAHjqQACDAMAAtkjZCEhtSw_8gOOaTQE", reply_to_message_id=message.id)
+    # 普通规则下取完的一方赢，反常规则下取完的一方输
+    if not game.can_move(a):
+        nim_over(message, not game.misere)
         return 
-    msg = robot_opt(a)
-    sent_msg = bot.reply_to(message, "我选择{},现在的石堆状态是{}\ntips:\n<tg-spoiler>{}</tg-spoiler>".format(msg, a, gentip(a)), parse_mode="HTML")
-    if not sum(a):
-        bot.reply_to(message, "菜就多练，输不起就别玩！")
-        bot.send_sticker(chat_id=message.chat.id, sticker="CAACAgQAAxkBAAICUGYZDa7nbIrY0R1g6AM7is5xeiejAAIPAwAC2SNkIeveH7n5wxyoNAQ", reply_to_message_id=message.id)
+    msg = robot_opt(game, a)
+    sent_msg = bot.reply_to(message, "我选择{},现在的石堆状态是{}\ntips:\n<tg-spoiler>{}</tg-spoiler>".format(msg, a, gentip(game, a)), parse_mode="HTML")
+    if not game.can_move(a):
+        nim_over(message, game.misere)
         return 
-    bot.register_next_step_handler(sent_msg, nim_round, a)
+    bot.register_next_step_handler(sent_msg, nim_round, game, a)
 
-@bot.message_handler(commands=['nim'])
 def nim(message):
-    a = gen()
+    try:
+        game = parse_nim(message.text)
+    except ValueError as e:
+        bot.reply_to(message, f"{e}\n用法：<code>/nim [堆数] [每堆最大个数] [sub=1,3,4] [misere]</code>", parse_mode="HTML")
+        return
+    a = game.gen()
+    if not game.can_move(a):
+        bot.reply_to(message, "生成的石堆无法进行任何操作，请调大每堆最大个数后重新开始")
+        return
+    take, win = game.rules()
     
     sent_msg = bot.reply_to(message, 
 """尼姆游戏
 今有{}堆石头，每堆石头分别有{}个。
-游戏玩法: 我们轮流先选定一堆石头，再<b>至少</b>取走一个石头，<b>至多</b>全部取完。<b>您先开始拿</b>。
-获胜条件：那一个先取完所有石头，谁就赢了
+游戏玩法: 我们轮流先选定一堆石头，{}。<b>您先开始拿</b>。
+获胜条件：{}
 每次轮到你操作时,发送<code>选择石堆 取走的数量</code>，例如<code>1 3</code>将取走第1堆的3个石头。
 tips:\n<tg-spoiler>{}</tg-spoiler>"""
-    .format(len(a), a, gentip(a, False)), parse_mode="HTML")
-    bot.register_next_step_handler(sent_msg, nim_round, a)
+    .format(len(a), a, take, win, gentip(game, a, False)), parse_mode="HTML")
+    bot.register_next_step_handler(sent_msg, nim_round, game, a)
 
-@bot.message_handler(commands=['start'])
 def start_command(message):
     logger.info(f"Start command received: {message}")
     bot.send_sticker(chat_id=message.chat.id, sticker="CAACAgQAAxkBAAICVGYZDg7Fg7hZ96S_Wp9t8O26xxxVAAITAwAC2SNkIbQZSopsDmMTNAQ", reply_to_message_id=message.id)
 
-@bot.message_handler(commands=['help'])
 def help_command(message):
     logger.info(f"Help command received: {message}")
     bot.send_sticker(chat_id=message.chat.id, sticker="CAACAgQAAxkBAAICWGYZDmNki3c5DiCYg9impkXVKXP9AAILAwAC2SNkIZ-71pEOj1BjNAQ", reply_to_message_id=message.id)
 
-logger.info("Starting bot...")
-bot.infinity_polling()
\ No newline at end of file
+if ROLE == 'worker':
+    logger.info("Starting worker...")
+    for t in start_workers(THREAD_POOL_SIZE):
+        t.join()
+else:
+    if ROLE == 'all':
+        start_workers(THREAD_POOL_SIZE)
+    bot.register_message_handler(stickerset, commands=['stickerset2gif'])
+    bot.register_message_handler(num, commands=['num'])
+    bot.register_message_handler(nim, commands=['nim'])
+    bot.register_message_handler(start_command, commands=['start'])
+    bot.register_message_handler(help_command, commands=['help'])
+    logger.info("Starting bot...")
+    bot.infinity_polling()
\ No newline at end of file